@@ -3,14 +3,15 @@
 #
 # Description: This script provides a web-based interface for a MISRA-C/C++
 #              violation fixer. It uses a local instance of cppcheck for static
-#              analysis and a local LLM (Llama CPP) to generate code patches.
+#              analysis and a local LLM (served by vLLM) to generate code
+#              patches.
 #
 # Author: Dipesh Karmakar
 #
 # This source code is licensed under the MIT License. See the LICENSE file in the
 # project root for the full license text.
 #
-# Version: 1.1
+# Version: 1.2
 # ==============================================================================
 
 import os
@@ -19,35 +20,134 @@ import subprocess
 import gradio as gr
 import shutil
 import sys
-import xml.etree.ElementTree as ET
+import time
+import atexit
+import urllib.request
+import io
+from lxml import etree
 import tempfile
-from llama_cpp import Llama
+import pathlib
+import hashlib
+import diskcache
+import asyncio
+import threading
+from openai import AsyncOpenAI, OpenAI
+from transformers import AutoTokenizer
 
-# 1. Local Model Setup
-# IMPORTANT: The model path now points to the file copied in the Dockerfile.
-LOCAL_MODEL_PATH = "/app/Model.gguf"
+# 1. Model Setup
+# The AWQ INT4 checkpoint is fetched from the Hugging Face Hub on first start.
+# Its fused INT4 kernels halve the weight bytes read per decoded token compared
+# to FP16, and the VRAM saved is left to the KV cache for concurrent requests.
+MODEL_NAME = "TheBloke/CodeLlama-7B-Instruct-AWQ"
 
-if not os.path.exists(LOCAL_MODEL_PATH):
-    print(f"Error: Local model path '{LOCAL_MODEL_PATH}' not found.", file=sys.stderr)
-    print("Please ensure the model file is copied into the container.", file=sys.stderr)
-    sys.exit(1)
+# Sampling parameters shared by every patch request.
+GENERATION_PARAMS = {
+    "max_tokens": 512, # Adjust max_tokens as needed for a longer patch.
+    "stop": ["[INST]"], # Stop generation when it hits the instruction token.
+    "temperature": 0 # Greedy decoding keeps the patch deterministic.
+}
 
-# 2. Initialize the Llama CPP client with the local GGUF model.
-try:
-    print(f"Loading local model from {LOCAL_MODEL_PATH}...")
-    # The Llama class from llama-cpp-python is used to load and run GGUF models.
-    # This value should be adjusted based on the available VRAM.
-    llm = Llama(
-        model_path=LOCAL_MODEL_PATH,
-        n_ctx=2048, # The maximum context size
-        n_gpu_layers=40, # Set to -1 for all layers, or a positive number.
-        n_batch=32
-    )
-    print("Model loaded successfully with GPU acceleration.")
-except Exception as e:
-    print(f"Error loading local model: {e}", file=sys.stderr)
+# 2. vLLM Server Setup
+# The model is served by vLLM's OpenAI-compatible server running next to the
+# Gradio app. Its scheduler batches concurrent requests at the iteration level
+# (continuous batching), so simultaneous uploads share the GPU instead of
+# queuing behind each other. Set VLLM_BASE_URL to use an already running server.
+VLLM_HOST = "127.0.0.1"
+VLLM_PORT = 8000
+VLLM_BASE_URL = os.environ.get("VLLM_BASE_URL", f"http://{VLLM_HOST}:{VLLM_PORT}/v1")
+VLLM_STARTUP_TIMEOUT = 600 # Seconds to wait for the model to load.
+
+# This value should be adjusted based on the available VRAM.
+VLLM_SERVER_ARGS = [
+    "--model", MODEL_NAME,
+    "--quantization", "awq",
+    "--host", VLLM_HOST,
+    "--port", str(VLLM_PORT),
+    "--dtype", "float16",
+    "--gpu-memory-utilization", "0.92",
+    "--max-model-len", "2048", # The maximum context size
+    # Storing the KV cache in FP8 halves its size and the bandwidth it takes to
+    # read it during decoding, so twice as many sequences fit in the same VRAM.
+    "--kv-cache-dtype", "fp8_e5m2",
+    "--max-num-seqs", "64", # Upper bound on sequences batched together.
+    "--enable-prefix-caching", # Reuse the KV cache of shared prompt prefixes.
+    # Speculative decoding: a cheap proposer drafts tokens that the model then
+    # verifies in one forward pass. The n-gram proposer copies spans from the
+    # prompt, which suits diffs that repeat the excerpted source lines. The
+    # acceptance rate is reported in the server's periodic metrics log; tune
+    # the number of speculative tokens between 3 and 7 based on it.
+    "--speculative-model", "[ngram]",
+    "--num-speculative-tokens", "5",
+    "--ngram-prompt-lookup-max", "4",
+    "--use-v2-block-manager"
+]
+
+# Identifies the model setup behind a generated patch: the served model, the
+# server it comes from and the engine settings (quantization, KV cache, ...).
+MODEL_ID = json.dumps([MODEL_NAME, VLLM_BASE_URL, VLLM_SERVER_ARGS])
+
+def start_vllm_server() -> subprocess.Popen:
+    """
+    Launches the vLLM OpenAI-compatible server as a sidecar process and waits
+    until it reports healthy.
+
+    Returns:
+        subprocess.Popen: The handle of the running server process.
+    """
+    print(f"Loading model {MODEL_NAME}...")
+    cmd = [sys.executable, "-m", "vllm.entrypoints.openai.api_server", *VLLM_SERVER_ARGS]
+    server = subprocess.Popen(cmd)
+    atexit.register(server.terminate)
+
+    # Poll the health endpoint until the model is loaded or the server dies.
+    health_url = f"http://{VLLM_HOST}:{VLLM_PORT}/health"
+    deadline = time.monotonic() + VLLM_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            print(f"Error loading local model: vLLM server exited with code {server.returncode}.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            with urllib.request.urlopen(health_url, timeout=5) as response:
+                if response.status == 200:
+                    print("Model loaded successfully with GPU acceleration.")
+                    return server
+        except OSError:
+            pass
+        time.sleep(2)
+
+    print(f"Error loading local model: vLLM server not ready after {VLLM_STARTUP_TIMEOUT}s.", file=sys.stderr)
     sys.exit(1)
 
+# The OpenAI client only talks HTTP; the API key is unused by a local vLLM server.
+client = AsyncOpenAI(base_url=VLLM_BASE_URL, api_key="EMPTY")
+
+# 3. Result Cache
+# cppcheck results and generated patches are stored on disk, keyed by a hash of
+# their input, so re-uploading a file skips the analysis and the model call.
+# The cache survives restarts of the app.
+CACHE_DIR = "/tmp/misra_cache"
+cache = diskcache.Cache(CACHE_DIR)
+
+# Part of the cppcheck results key. Bump it whenever the cppcheck command line or
+# the issue parsing changes, so results of the old analysis are not reused.
+CPPCHECK_CACHE_VERSION = 4
+
+# Part of the patch key. Bump it whenever the prompt handling or the way patches
+# are generated changes in a way the key below does not capture.
+PATCH_CACHE_VERSION = 1
+
+def content_hash(text: str) -> str:
+    """
+    Computes a short BLAKE2 digest of a string for use as a cache key.
+
+    Args:
+        text (str): The text to hash.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
 def ensure_tool(name: str):
     """
     Checks if a command-line tool is available in the system's PATH.
@@ -59,75 +159,164 @@ def ensure_tool(name: str):
         print(f"Error: `{name}` not found. Please install it and retry.", file=sys.stderr)
         sys.exit(1)
 
+# Concurrent requests share one budget of cppcheck processes, one per available
+# core, so that parallel uploads do not oversubscribe the CPU.
+cppcheck_slots = threading.BoundedSemaphore(len(os.sched_getaffinity(0)))
+
+# cppcheck error ids meaning that the file could not be fully analyzed, so MISRA
+# findings may be missing from the results. Such runs are treated as failures.
+ANALYSIS_ERROR_IDS = ("syntaxError", "unknownMacro", "internalError", "preprocessorErrorDirective")
+
 def run_cppcheck(source_code: str, filename: str) -> list:
     """
-    Runs cppcheck on the provided source code and parses the XML output for issues.
+    Runs cppcheck with the MISRA addon on the provided source code and parses the
+    XML output for MISRA issues.
     
-    This function has been optimized to use temporary files from the `tempfile`
-    module, which is more secure and automatically handles cleanup.
+    The XML report that cppcheck writes to stderr is captured in memory and
+    parsed directly, so only the source code goes through a temporary file.
     
     Args:
         source_code (str): The content of the source file.
         filename (str): The name of the source file, used to determine the language.
         
     Returns:
-        list: A list of dictionaries, where each dictionary represents a detected issue.
+        list: A list of dictionaries, where each dictionary represents a detected issue,
+              or None if cppcheck failed, its output could not be parsed, or it could
+              not fully analyze the file.
     """
-    ensure_tool("cppcheck")
-    
     issues = []
+    # Set when cppcheck reports that the file could not be fully analyzed.
+    analysis_error = False
 
-    # Use a temporary file for the source code, which is automatically cleaned up.
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.c', encoding='utf-8') as src_file, \
-         tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.xml', encoding='utf-8') as xml_file:
-        
-        src_file_path = src_file.name
-        xml_file_path = xml_file.name
-        
-        src_file.write(source_code)
-        src_file.flush() # Ensure all data is written to the file
-        
-        # Select language and standard based on the file extension.
-        if filename.endswith(".c"):
-            lang_args = ["--std=c99", "--language=c", "--addon=misra"]
-        else:
-            lang_args = ["--std=c++17", "--language=c++", "--addon=misra"]
+    # Select language and standard based on the file extension.
+    if filename.endswith(".c"):
+        lang_args = ["--std=c99", "--language=c"]
+    else:
+        lang_args = ["--std=c++17", "--language=c++"]
+
+    # cppcheck needs the source code on disk; the directory is removed once it has run.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_file_path = os.path.join(tmp_dir, "source.c")
+        with open(src_file_path, 'w', encoding='utf-8') as src_file:
+            src_file.write(source_code)
 
         # Construct and run the cppcheck command.
-        cmd = ["cppcheck", "--enable=all", "--xml", *lang_args, src_file_path]
+        # The MISRA addon reports its findings with style severity, so only the style
+        # checks are enabled instead of all of them (information, unusedFunction, ...).
+        cmd = ["cppcheck", "--enable=style", "--addon=misra", "--xml", *lang_args, src_file_path]
+        xml_output = b""
         try:
-            # Redirect stderr to the temporary XML file.
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=xml_file, text=True, encoding='utf-8')
-
-            # Rewind the XML file and parse its contents.
-            xml_file.seek(0)
-            tree = ET.parse(xml_file)
-            root = tree.getroot()
+            # cppcheck writes the XML report to stderr; keep it in memory.
+            with cppcheck_slots:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            xml_output = result.stderr
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, cmd)
             
-            # Extract issue information from the XML.
-            for error_element in root.findall(".//error"):
+            # Stream the <error> elements out of the XML and extract the MISRA issues,
+            # clearing each element once read so the full tree is never built.
+            for _, error_element in etree.iterparse(io.BytesIO(xml_output), tag='error'):
+                error_id = error_element.get('id', '')
                 location = error_element.find('location')
-                if location is not None:
+                if location is not None and error_id.startswith('misra'):
+                    file = location.get('file')
+                    # Report locations in the temporary file against the uploaded file.
+                    if file == src_file_path:
+                        file = os.path.basename(filename)
                     issue = {
                         "severity": error_element.get('severity'),
-                        "id": error_element.get('id'),
+                        "id": error_id,
                         "msg": error_element.get('msg'),
                         "verbose": error_element.get('verbose'),
-                        "file": location.get('file'),
+                        "file": file,
                         "line": location.get('line'),
                         "column": location.get('column')
                     }
                     issues.append(issue)
+                elif error_id in ANALYSIS_ERROR_IDS:
+                    print(f"Error: cppcheck could not fully analyze {filename} ({error_id}): {error_element.get('msg')}", file=sys.stderr)
+                    analysis_error = True
+                error_element.clear()
 
-        except (subprocess.CalledProcessError, ET.ParseError) as e:
+        except (subprocess.CalledProcessError, etree.XMLSyntaxError) as e:
             print(f"An error occurred during cppcheck execution or XML parsing: {e}", file=sys.stderr)
-            # Read the raw output for debugging
-            xml_file.seek(0)
-            print(f"Raw cppcheck XML output:\n{xml_file.read()}", file=sys.stderr)
-            
-    # The temporary files are automatically deleted here
+            # Print the raw output for debugging
+            print(f"Raw cppcheck XML output:\n{xml_output.decode('utf-8', errors='replace')}", file=sys.stderr)
+            return None
+
+    # The MISRA addon reports nothing for code cppcheck could not parse, so an
+    # empty or partial list here would wrongly read as a clean file.
+    if analysis_error:
+        return None
+
     return issues
 
+# Prompt templates in the specific instruct format for CodeLlama models, built
+# once per supported language at startup. The prefix (role, instructions and the
+# opening of the excerpts block) is the same for every file of a language.
+_PROMPT_PREFIX = """[INST] You are a {expert} specializing in {rule_set} compliance.
+Produce a unified diff patch that fixes all violations reported below. For each change, include a one‐sentence rationale referencing the violated rule number.
+Each excerpt of the source file starts with a comment giving its original line numbers; use them so the diff hunks carry the correct line numbers.
+Only return the diff. No extra commentary.
+Here are the relevant excerpts of the source file:
+```
+"""
+_PROMPT_BODY = """{source}
+```
+The static analyzer reported the following violations:
+{summary} [/INST]"""
+
+PROMPT_PREFIX_C = _PROMPT_PREFIX.format(expert="C expert", rule_set="MISRA C:2012")
+PROMPT_PREFIX_CPP = _PROMPT_PREFIX.format(expert="C++ expert", rule_set="MISRA C++:2012")
+TEMPLATE_C = PROMPT_PREFIX_C + _PROMPT_BODY
+TEMPLATE_CPP = PROMPT_PREFIX_CPP + _PROMPT_BODY
+
+# The prompts are tokenized in the app and sent to the server as token ids. The
+# prefixes are tokenized once here, so a request only tokenizes its own tail.
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+PROMPT_PREFIX_IDS_C = tokenizer.encode(PROMPT_PREFIX_C)
+PROMPT_PREFIX_IDS_CPP = tokenizer.encode(PROMPT_PREFIX_CPP)
+_NEWLINE_IDS = tokenizer.encode("\n", add_special_tokens=False)
+
+# Number of source lines sent to the model on each side of a violation.
+CONTEXT_LINES = 30
+
+def extract_windows(source_code: str, filename: str, issues: list) -> str:
+    """
+    Cuts the source code down to the lines surrounding the reported issues.
+    Overlapping windows are merged, and each one is headed by a comment giving
+    its original line range.
+    
+    Args:
+        source_code (str): The original source code.
+        filename (str): The name of the file.
+        issues (list): A list of dictionaries representing the detected issues.
+        
+    Returns:
+        str: The numbered excerpts, or the whole source code if no issue has a line number.
+    """
+    lines = source_code.splitlines()
+    
+    # Build a [lo, hi) window of line indexes around every issue and merge overlaps.
+    windows = []
+    for lo, hi in sorted(
+        (max(0, int(issue['line']) - CONTEXT_LINES), int(issue['line']) + CONTEXT_LINES)
+        for issue in issues if (issue.get('line') or '').isdigit()
+    ):
+        if windows and lo <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+
+    if not windows:
+        return source_code
+
+    name = os.path.basename(filename)
+    return "\n".join(
+        f"// {name} lines {lo + 1}-{min(hi, len(lines))}\n" + "\n".join(lines[lo:hi])
+        for lo, hi in windows
+    )
+
 def build_prompt(source_code: str, filename: str, issues: list) -> str:
     """
     Builds the prompt for the language model based on the parsed issues.
@@ -150,105 +339,181 @@ def build_prompt(source_code: str, filename: str, issues: list) -> str:
         for issue in issues
     ])
 
-    rule_set = "MISRA C:2012" if filename.endswith(".c") else "MISRA C++:2012"
-    
-    # Use the specific instruct format for CodeLlama models.
-    prompt_template = f"""
-[INST] You are a { 'C expert' if 'C:2012' in rule_set else 'C++ expert' } specializing in {rule_set} compliance.
-Here is the source file:
-```
-{source_code}
-```
-The static analyzer reported the following violations:
-{summary}
-Produce a unified diff patch that fixes all violations. For each change, include a one‐sentence rationale referencing the violated rule number.
-Only return the diff. No extra commentary. [/INST]
-"""
-    return prompt_template.strip()
+    # Only send the code around the violations instead of the whole file.
+    excerpts = extract_windows(source_code, filename, issues)
+
+    # The instructions repeat across requests and come first, and the request
+    # specific excerpts and issue summary come last, so the server's prefix cache can
+    # reuse the KV cache of the longest common prefix.
+    template = TEMPLATE_C if filename.endswith(".c") else TEMPLATE_CPP
+    return template.format(source=excerpts, summary=summary)
 
-def predict_patch(prompt: str) -> str:
+def tokenize_prompt(prompt: str) -> list:
     """
-    Calls the local Llama model to generate a patch based on the prompt.
+    Converts a prompt built by build_prompt into token ids, reusing the
+    pre-tokenized prefix of its language.
     
     Args:
         prompt (str): The formatted prompt string for the LLM.
         
     Returns:
-        str: The generated patch string.
+        list: The token ids of the prompt.
     """
+    for prefix, prefix_ids in ((PROMPT_PREFIX_C, PROMPT_PREFIX_IDS_C), (PROMPT_PREFIX_CPP, PROMPT_PREFIX_IDS_CPP)):
+        if prompt.startswith(prefix):
+            # The prefixes end with a newline, which never merges with the text
+            # after it. Encoding the tail behind a newline and dropping the
+            # newline's ids avoids the leading space SentencePiece adds to a text,
+            # so the result matches tokenizing the whole prompt.
+            tail_ids = tokenizer.encode("\n" + prompt[len(prefix):], add_special_tokens=False)
+            return prefix_ids + tail_ids[len(_NEWLINE_IDS):]
+    return tokenizer.encode(prompt)
+
+def warm_prefix_cache():
+    """
+    Prefills the stable prompt prefix of each language once at startup, so the
+    server's prefix cache already holds it when the first upload arrives.
+    """
+    # A synchronous client, as the async one must stay bound to Gradio's event loop.
+    warmup_client = OpenAI(base_url=VLLM_BASE_URL, api_key="EMPTY")
+    for prefix_ids in (PROMPT_PREFIX_IDS_C, PROMPT_PREFIX_IDS_CPP):
+        try:
+            warmup_client.completions.create(model=MODEL_NAME, prompt=prefix_ids, max_tokens=1)
+        except Exception as e:
+            # A failed warm-up only costs the cache hit; patch requests still run.
+            print(f"Error while warming the prefix cache: {e}", file=sys.stderr)
+
+async def predict_patch(prompt: str):
+    """
+    Calls the vLLM server to generate a patch based on the prompt, streaming the
+    tokens as they are generated.
+    
+    Each prompt is sent as its own request; the server's scheduler batches
+    concurrent requests together, and a prompt that the server rejects only
+    fails its own request.
+    
+    Args:
+        prompt (str): The formatted prompt string for the LLM.
+        
+    Yields:
+        str: The patch generated so far.
+    """
+    patch = ""
     try:
-        # Call the Llama instance with the prompt to get the patch.
-        response = llm(
-            prompt,
-            max_tokens=512, # Adjust max_tokens as needed for a longer patch.
-            stop=["[INST]"], # Stop generation when it hits the instruction token.
-            echo=False # Do not include the prompt in the output.
+        response = await client.completions.create(
+            model=MODEL_NAME,
+            prompt=tokenize_prompt(prompt),
+            stream=True,
+            **GENERATION_PARAMS
         )
-        
-        # Extract the text from the LLM's response.
-        patch = response["choices"][0]["text"]
-        return patch
+        async for chunk in response:
+            patch += chunk.choices[0].text
+            yield patch
     except Exception as e:
         print(f"Error during local model inference: {e}", file=sys.stderr)
         raise e
 
-def process_file(file_obj) -> tuple:
+async def process_file(file_obj):
     """
-    Main function to process an uploaded file.
+    Main function to process an uploaded file, streaming the patch as it is generated.
     It orchestrates the entire workflow: file reading, analysis, prompt building, and patch generation.
     
-    This version includes a fix to handle cases where file_obj is a string path
-    instead of a file-like object, which can occur with some Gradio versions.
+    The upload is read from the path in file_obj.name; file-like objects without
+    a usable path are read directly instead.
     
     Args:
         file_obj: The file object uploaded via the Gradio interface.
         
-    Returns:
-        tuple: A tuple containing the result message and the generated patch (or None).
+    Yields:
+        tuple: A tuple containing the result message and the patch generated so far (or None).
     """
     if file_obj is None:
-        return "Error: No file uploaded.", None
+        yield "Error: No file uploaded.", None
+        return
 
     filename = file_obj.name
     
     try:
-        # Check if the input is a string (a file path) or a file-like object.
-        if isinstance(file_obj.name, str):
-            with open(file_obj.name, 'r', encoding='utf-8') as f:
-                src = f.read()
-        else:
+        # Read the upload straight from its path, decoding in C without an
+        # intermediate bytes object. Fall back to reading the file-like object
+        # itself if it has no usable path.
+        try:
+            src = pathlib.Path(file_obj.name).read_text(encoding="utf-8", errors="replace")
+        except (AttributeError, TypeError):
             file_obj.seek(0)
-            src = file_obj.read().decode()
+            src = file_obj.read().decode("utf-8", errors="replace")
     except Exception as e:
-        return f"Failed to read file: {e}", None
+        yield f"Failed to read file: {e}", None
+        return
 
     if not src:
-        return "Error: The uploaded file appears to be empty.", None
+        yield "Error: The uploaded file appears to be empty.", None
+        return
 
-    issues = run_cppcheck(src, filename)
+    # Reuse the cppcheck results of an identical earlier upload if there are any.
+    # The issues name the uploaded file, so its name is part of the key.
+    issues_key = ("issues", CPPCHECK_CACHE_VERSION, content_hash(src), os.path.basename(filename))
+    issues = cache.get(issues_key)
+    if issues is None:
+        # cppcheck blocks, so run it in a worker thread to keep the event loop free.
+        issues = await asyncio.to_thread(run_cppcheck, src, filename)
+        # Only successful analyses are cached, so a failed run is retried next time.
+        if issues is None:
+            yield "Error: cppcheck could not fully analyze the file. See the server log for details.", None
+            return
+        cache.set(issues_key, issues)
     
     prompt = build_prompt(src, filename, issues)
     if prompt is None:
-        return "No MISRA violations found.", None
+        yield "No MISRA violations found.", None
+        return
     
+    # Reuse the patch generated for an identical earlier prompt if there is one.
+    # The model and sampling parameters are part of the key, so changing either
+    # does not serve patches produced by the old setup.
+    patch_key = (
+        "patch", PATCH_CACHE_VERSION, MODEL_ID,
+        json.dumps(GENERATION_PARAMS, sort_keys=True), content_hash(prompt)
+    )
+    patch = cache.get(patch_key)
+    if patch is not None:
+        yield "Patch generated below:", patch
+        return
+
     try:
-        patch = predict_patch(prompt)
-        return "Patch generated below:", patch
+        patch = ""
+        async for patch in predict_patch(prompt):
+            yield "Generating patch...", patch
+        cache.set(patch_key, patch)
+        yield "Patch generated below:", patch
     except Exception as e:
-        return f"An error occurred during local model inference: {e}", None
+        yield f"An error occurred during local model inference: {e}", None
 
 def main():
     """
-    Sets up and launches the Gradio interface.
+    Checks for cppcheck, starts the vLLM server (unless an external one is
+    configured), warms its prefix cache and then sets up and launches the
+    Gradio interface.
     """
+    # Check for cppcheck once at startup instead of on every request.
+    ensure_tool("cppcheck")
+
+    if "VLLM_BASE_URL" not in os.environ:
+        start_vllm_server()
+    warm_prefix_cache()
+
     iface = gr.Interface(
         fn=process_file,
         inputs=gr.File(file_types=[".c", ".cpp", ".h", ".hpp"]),
         outputs=[gr.Text(label="Status"), gr.Code(label="Patch")],
         title="MISRA Smart Fixer",
         description="Upload C/C++ code to auto-fix MISRA violations.",
-        allow_flagging="never"
+        allow_flagging="never",
+        api_name="fix"
     )
+    # Let several requests run at once so they reach the vLLM scheduler together.
+    # The queue also streams each partial patch yielded by process_file to the UI.
+    iface.queue(default_concurrency_limit=16)
     iface.launch(server_name="0.0.0.0", server_port=7860)
 
 if __name__ == "__main__":